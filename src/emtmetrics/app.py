@@ -1,5 +1,7 @@
+import asyncio
 import logging
 import os
+from contextlib import asynccontextmanager
 
 from fastapi import FastAPI
 
@@ -27,8 +29,31 @@ if os.environ.get("DEBUGPY", "0") == "1":
     debugpy.listen(("0.0.0.0", 5678))
     logger.info("Debugger can attach at port 5678")
 
+
+async def warmup_stops():
+    """Preload the stops of every line and direction, so first requests don't pay for the stops query"""
+    try:
+        pairs = await asyncio.to_thread(mysql_manager.line_directions)
+        warmed = await asyncio.to_thread(influxdb_manager.warmup, pairs)
+        logger.info("Stops preloaded for %d of %d lines and directions", warmed, len(pairs))
+    except Exception:
+        logger.exception("Stops warmup failed")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    warmup_task = None
+    if os.environ.get("WARMUP_STOPS", "1") == "1":
+        warmup_task = asyncio.create_task(warmup_stops())
+    yield
+    if warmup_task is not None:
+        warmup_task.cancel()
+    influxdb_manager.close()
+
+
 # Initialize FastAPI app
-app = FastAPI(title="Bus Prediction API", description="Simple API for bus predictions", version="1.0.0")
+app = FastAPI(title="Bus Prediction API", description="Simple API for bus predictions", version="1.0.0",
+              lifespan=lifespan)
 app.include_router(prediction_router)
 app.include_router(details_router)
 
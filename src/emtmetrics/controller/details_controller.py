@@ -1,3 +1,4 @@
+import asyncio
 import logging
 from typing import List, Tuple
 
@@ -28,7 +29,7 @@ async def get_bus_details(
         if not bus_id.startswith("buses:"):
             raise HTTPException(status_code=400, detail="Invalid bus_id format. Must start with 'buses:'")
 
-        return service.get_bus_details(bus_id)
+        return await service.get_bus_details(bus_id)
 
     except HTTPException as http_exc:
         raise http_exc
@@ -50,7 +51,7 @@ async def get_shape_details(
         if not bus_id.startswith("buses:"):
             raise HTTPException(status_code=400, detail="Invalid bus_id format. Must start with 'buses:'")
 
-        route_data = service.get_route_data(bus_id)
+        route_data = await asyncio.to_thread(service.get_route_data, bus_id)
 
         coordinates =  route_data.route_coordinates
         points = [Point(latitude=lat, longitude=lon) for lat, lon in coordinates]
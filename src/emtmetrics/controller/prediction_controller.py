@@ -40,7 +40,7 @@ async def predict_future_position(request: PositionPredictionRequest, service=De
         if request.prediction_time_seconds <= 0 or request.prediction_time_seconds > 3600:
             raise HTTPException(status_code=400, detail="Prediction time must be between 1 and 3600 seconds (1 hour)")
 
-        result = service.calculate_predicted_position(request.bus_id, request.prediction_time_seconds)
+        result = await service.calculate_predicted_position(request.bus_id, request.prediction_time_seconds)
 
         return PositionPredictionResponse(
             bus_id=request.bus_id,
@@ -78,7 +78,7 @@ async def predict_arrival_time_by_coords(request: TimePredictionByCoordinatesReq
 
 
         # Validate prediction time limit
-        result = service.calculate_predicted_arrival_by_coords(
+        result = await service.calculate_predicted_arrival_by_coords(
             request.bus_id,
             request.target_location
         )
@@ -114,7 +114,7 @@ async def predict_arrival_time_by_distance(request: TimePredictionByDistanceTrav
             raise HTTPException(status_code=400, detail="Invalid bus_id format. Must start with 'buses:'")
 
         # Validate prediction time limit
-        result = service.calculate_predicted_arrival_time_by_distance(
+        result = await service.calculate_predicted_arrival_time_by_distance(
             request.bus_id,
             request.target_location
         )
@@ -153,7 +153,7 @@ async def predict_arrival_time_by_stop(request: TimePredictionByStopRequest, ser
             raise HTTPException(status_code=400, detail="Invalid bus_id format. Must start with 'buses:'")
 
         # Validate prediction time limit
-        result = service.calculate_predicted_arrival_time_by_stop(
+        result = await service.calculate_predicted_arrival_time_by_stop(
             request.bus_id,
             request.stop_order
         )
@@ -1,16 +1,29 @@
 from datetime import datetime
-from typing import Any, List, Tuple
+from typing import Any, Optional, Tuple
 from dataclasses import dataclass
 
+import numpy as np
+from scipy.spatial import cKDTree
 
-@dataclass
+
+@dataclass(slots=True, frozen=True)
 class RouteData:
     """Encapsulates route information"""
     bus_shape: Any
-    route_coordinates: List[Tuple]
-    distance_traveled_list: List[int]
+    route_coordinates: np.ndarray  # (N, 2) with lat, lon columns
+    distance_traveled_list: np.ndarray  # (N,) distance traveled of each route point
+    search_coordinates: np.ndarray  # (N, 2) float32 copy of route_coordinates for the nearest segment search
+    # Per segment coefficients (N - 1 elements each), see calculations.precompute_segments
+    seg_origin_lat: np.ndarray
+    seg_origin_lon: np.ndarray
+    seg_dx: np.ndarray
+    seg_dy: np.ndarray
+    seg_inv_len2: np.ndarray
+    seg_len: np.ndarray  # straight length in meters, see calculations.segment_lengths
+    # Built over search_coordinates once the shape is requested again, until then a linear scan is used
+    search_tree: Optional[cKDTree] = None
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class PositionPair:
     """Represents a pair of GPS positions with metadata"""
     first_position: Tuple[float, float]
@@ -20,15 +33,17 @@ class PositionPair:
     first_timestamp: datetime
     last_timestamp: datetime
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class CorrectedPositions:
     """Holds corrected GPS positions and their route segments"""
     first_corrected: Tuple[float, float]
     last_corrected: Tuple[float, float]
     first_segment: Tuple
     last_segment: Tuple
+    first_seg_index: int  # index of the segment's first point in the route
+    last_seg_index: int
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class SegmentDistances:
     """Contains distance measurements for route segments"""
     first_segment_point_a: float
@@ -36,13 +51,13 @@ class SegmentDistances:
     last_segment_point_a: float
     last_segment_point_b: float
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class AbsoluteDistances:
     """Absolute distance measurements along the route"""
     first_point_distance: float
     last_point_distance: float
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class TravelMetrics:
     """Final travel calculation results"""
     distance_traveled: float
@@ -0,0 +1,15 @@
+from dataclasses import dataclass
+
+import numpy as np
+
+
+@dataclass(slots=True, frozen=True)
+class ShapeArrays:
+    """Shape points stored column-wise, ordered by sequence"""
+    lat: np.ndarray  # (N,) float64
+    lon: np.ndarray  # (N,) float64
+    seq: np.ndarray  # (N,) int32
+    dist: np.ndarray  # (N,) float64 distance traveled
+
+    def __len__(self) -> int:
+        return len(self.seq)
@@ -1,8 +1,12 @@
+import asyncio
 import logging
+from dataclasses import replace
 from datetime import datetime, timedelta
-from typing import Any, Dict
+from typing import Any, Dict, List, Tuple
 
+import numpy as np
 from fastapi import HTTPException
+from scipy.spatial import cKDTree
 
 from ..model.bus_details_response import BusDetailsResponse
 from ..model.prediction_service_aux_data import TravelMetrics, AbsoluteDistances, PositionPair, CorrectedPositions, \
@@ -10,6 +14,7 @@ from ..model.prediction_service_aux_data import TravelMetrics, AbsoluteDistances
 from ..model.location_request import LocationRequest
 from ..utils.influxdb_manager import InfluxDBManager
 from ..utils.mysql_manager import MySQLManager
+from ..utils.ttl_cache import TTLCache
 from ..utils.calculations import *
 
 logger = logging.getLogger(__name__)
@@ -19,6 +24,10 @@ class PredictionService:
     def __init__(self, influxdb_manager: InfluxDBManager, mysql_manager: MySQLManager):
         self.influxdb_manager = influxdb_manager
         self.mysql_manager = mysql_manager
+        # Route geometry is static per shape, so it is loaded and preprocessed once
+        self._route_cache: Dict[Any, RouteData] = {}
+        # Speeds only change when a new GPS fix arrives, see calculate_average_speed
+        self._speed_cache = TTLCache(maxsize=10_000, ttl=5.0)
 
     def get_bus_shape(self, bus_id: str) -> Any:
         """Get bus shape information for the given bus ID"""
@@ -35,32 +44,64 @@ class PredictionService:
         return self.mysql_manager.get_bus_shape(line_id, direction_id)
 
     def get_route_data(self, bus_id: str) -> RouteData:
-        """Extract and prepare route data for calculations"""
+        """Extract and prepare route data for calculations, cached per bus shape"""
         bus_shape = self.get_bus_shape(bus_id)
         if not bus_shape:
             raise ValueError("No bus shape found")
 
-        logger.info(f"Retrieved bus shape: {bus_shape}")
+        logger.info("Retrieved bus shape: %s", bus_shape)
 
+        route_data = self._route_cache.get(bus_shape)
+        if route_data is None:
+            route_data = self._load_route_data(bus_shape)
+            self._route_cache[bus_shape] = route_data
+        elif route_data.search_tree is None:
+            # The shape is requested again, so building its tree now pays off
+            route_data = replace(route_data, search_tree=cKDTree(route_data.search_coordinates))
+            self._route_cache[bus_shape] = route_data
+
+        return route_data
+
+    def _load_route_data(self, bus_shape: Any) -> RouteData:
+        """Load route points for the given shape and precompute its segment coefficients"""
         shape_points = self.mysql_manager.shape_points(bus_shape)
-        if not shape_points:
+        if len(shape_points) == 0:
             raise ValueError("No route points found in database")
 
-        logger.info(f"Retrieved {len(shape_points)} route points from database")
+        logger.info("Retrieved %d route points from database", len(shape_points))
 
-        route_coordinates = [(row[0], row[1]) for row in shape_points]  # lat, lon
-        distance_traveled_list = [row[3] for row in shape_points]
+        route_coordinates = np.column_stack((shape_points.lat, shape_points.lon))
+        distance_traveled_list = shape_points.dist
+        # float32 keeps ~0.4m resolution at these latitudes and halves the bytes scanned per search. Only the
+        # nearest point search uses it, the projection onto the few candidate segments stays float64
+        search_coordinates = route_coordinates.astype(np.float32)
+        seg_origin_lat, seg_origin_lon, seg_dx, seg_dy, seg_inv_len2 = precompute_segments(route_coordinates)
 
         return RouteData(
             bus_shape=bus_shape,
             route_coordinates=route_coordinates,
-            distance_traveled_list=distance_traveled_list
+            distance_traveled_list=distance_traveled_list,
+            search_coordinates=search_coordinates,
+            seg_origin_lat=seg_origin_lat,
+            seg_origin_lon=seg_origin_lon,
+            seg_dx=seg_dx,
+            seg_dy=seg_dy,
+            seg_inv_len2=seg_inv_len2,
+            seg_len=segment_lengths(route_coordinates)
         )
 
-    def _get_bus_positions(self, bus_id: str) -> List[Dict]:
-        """Get bus positions from InfluxDB with validation"""
-        bus_positions = self.influxdb_manager.bus_positions(bus_id)
-        logger.info(f"Retrieved {len(bus_positions)} position points from InfluxDB")
+    def _get_bus_positions(self, bus_id: str, first_index: int = 0, last_index: int = -1) -> List[Dict]:
+        """
+        Get bus positions from InfluxDB with validation.
+
+        With the default indices only the first and last positions are needed, so just those
+        two rows are requested instead of the whole route.
+        """
+        if first_index == 0 and last_index == -1:
+            bus_positions = self.influxdb_manager.first_and_last_positions(bus_id)
+        else:
+            bus_positions = self.influxdb_manager.bus_positions(bus_id)
+        logger.info("Retrieved %d position points from InfluxDB", len(bus_positions))
 
         if len(bus_positions) < 2:
             raise ValueError("Insufficient position points (min 2 required)")
@@ -76,8 +117,8 @@ class PredictionService:
         first_position = (first_pos_data['latitude'], first_pos_data['longitude'])
         last_position = (last_pos_data['latitude'], last_pos_data['longitude'])
 
-        logger.debug(f"First position: {first_position}")
-        logger.debug(f"Last position: {last_position}")
+        logger.debug("First position: %s", first_position)
+        logger.debug("Last position: %s", last_position)
 
         return PositionPair(
             first_position=first_position,
@@ -92,54 +133,40 @@ class PredictionService:
                            position_pair: PositionPair) -> CorrectedPositions:
         """Correct positions using route shape points"""
         logger.info("Correcting first position...")
-        first_corrected, _, first_segment = correct_position(
-            route_data.route_coordinates, position_pair.first_position
+        first_corrected, _, first_segment, first_seg_index = correct_position(
+            route_data, position_pair.first_position
         )
 
         logger.info("Correcting last position...")
-        last_corrected, _, last_segment = correct_position(
-            route_data.route_coordinates, position_pair.last_position
+        last_corrected, _, last_segment, last_seg_index = correct_position(
+            route_data, position_pair.last_position
         )
 
-        logger.debug(f"First position corrected: {first_corrected}")
-        logger.debug(f"Last position corrected: {last_corrected}")
+        logger.debug("First position corrected: %s", first_corrected)
+        logger.debug("Last position corrected: %s", last_corrected)
 
         return CorrectedPositions(
             first_corrected=first_corrected,
             last_corrected=last_corrected,
             first_segment=first_segment,
-            last_segment=last_segment
+            last_segment=last_segment,
+            first_seg_index=first_seg_index,
+            last_seg_index=last_seg_index
         )
 
     def _calculate_segment_distances(self, route_data: RouteData,
                                      corrected_positions: CorrectedPositions) -> SegmentDistances:
-        """Calculate distances for position segments"""
+        """Calculate distances for position segments from the route's distance traveled column"""
         logger.info("Calculating segment distances...")
 
-        first_segment_point_a = self.mysql_manager.dist_traveled(
-            route_data.bus_shape,
-            corrected_positions.first_segment[0][0],
-            corrected_positions.first_segment[0][1]
-        )
-        first_segment_point_b = self.mysql_manager.dist_traveled(
-            route_data.bus_shape,
-            corrected_positions.first_segment[1][0],
-            corrected_positions.first_segment[1][1]
-        )
+        distance_traveled = route_data.distance_traveled_list
+        first_segment_point_a = float(distance_traveled[corrected_positions.first_seg_index])
+        first_segment_point_b = float(distance_traveled[corrected_positions.first_seg_index + 1])
+        last_segment_point_a = float(distance_traveled[corrected_positions.last_seg_index])
+        last_segment_point_b = float(distance_traveled[corrected_positions.last_seg_index + 1])
 
-        last_segment_point_a = self.mysql_manager.dist_traveled(
-            route_data.bus_shape,
-            corrected_positions.last_segment[0][0],
-            corrected_positions.last_segment[0][1]
-        )
-        last_segment_point_b = self.mysql_manager.dist_traveled(
-            route_data.bus_shape,
-            corrected_positions.last_segment[1][0],
-            corrected_positions.last_segment[1][1]
-        )
-
-        logger.debug(f"First segment distances: a={first_segment_point_a}m, b={first_segment_point_b}m")
-        logger.debug(f"Last segment distances: a={last_segment_point_a}m, b={last_segment_point_b}m")
+        logger.debug("First segment distances: a=%sm, b=%sm", first_segment_point_a, first_segment_point_b)
+        logger.debug("Last segment distances: a=%sm, b=%sm", last_segment_point_a, last_segment_point_b)
 
         return SegmentDistances(
             first_segment_point_a=first_segment_point_a,
@@ -148,7 +175,7 @@ class PredictionService:
             last_segment_point_b=last_segment_point_b
         )
 
-    def _calculate_absolute_distances(self, corrected_positions: CorrectedPositions,
+    def _calculate_absolute_distances(self, route_data: RouteData, corrected_positions: CorrectedPositions,
                                       segment_distances: SegmentDistances) -> AbsoluteDistances:
         """Calculate absolute distances along the route"""
         logger.info("Calculating route distances...")
@@ -157,20 +184,22 @@ class PredictionService:
             corrected_positions.first_segment[0],
             corrected_positions.first_segment[1],
             corrected_positions.first_corrected,
-            segment_distances.first_segment_point_b - segment_distances.first_segment_point_a
+            segment_distances.first_segment_point_b - segment_distances.first_segment_point_a,
+            float(route_data.seg_len[corrected_positions.first_seg_index])
         )
 
         relative_last_distance = calculate_distance_along_route(
             corrected_positions.last_segment[0],
             corrected_positions.last_segment[1],
             corrected_positions.last_corrected,
-            segment_distances.last_segment_point_b - segment_distances.last_segment_point_a
+            segment_distances.last_segment_point_b - segment_distances.last_segment_point_a,
+            float(route_data.seg_len[corrected_positions.last_seg_index])
         )
 
         absolute_first_distance = relative_first_distance + segment_distances.first_segment_point_a
         absolute_last_distance = relative_last_distance + segment_distances.last_segment_point_a
 
-        logger.info(f"Distances - First: {absolute_first_distance:.2f}m, Last: {absolute_last_distance:.2f}m")
+        logger.info("Distances - First: %.2fm, Last: %.2fm", absolute_first_distance, absolute_last_distance)
 
         return AbsoluteDistances(
             first_point_distance=absolute_first_distance,
@@ -184,14 +213,14 @@ class PredictionService:
         time_elapsed = position_pair.last_timestamp - position_pair.first_timestamp
         time_elapsed_seconds = time_elapsed.total_seconds()
 
-        logger.info(f"Time elapsed: {time_elapsed_seconds} seconds ({time_elapsed_seconds / 3600:.4f} hours)")
+        logger.info("Time elapsed: %s seconds (%.4f hours)", time_elapsed_seconds, time_elapsed_seconds / 3600)
 
         if time_elapsed_seconds <= 0:
             raise ValueError("Invalid time elapsed: must be positive")
 
         average_speed = distance_traveled / time_elapsed_seconds
 
-        logger.info(f"Average speed: {average_speed:.2f} m/s ({average_speed * 3.6:.2f} km/h)")
+        logger.info("Average speed: %.2f m/s (%.2f km/h)", average_speed, average_speed * 3.6)
 
         return TravelMetrics(
             distance_traveled=distance_traveled,
@@ -200,40 +229,70 @@ class PredictionService:
             average_speed=average_speed
         )
 
-    def calculate_average_speed(self, bus_id: str, first_point_index: int,
-                                last_point_index: int) -> tuple[float, datetime, float, list[int], int]:
+    def _calculate_route_travel(self, route_data: RouteData, bus_positions: List[Dict],
+                                first_point_index: int,
+                                last_point_index: int) -> Tuple[AbsoluteDistances, TravelMetrics]:
+        """Run the position correction and distance pipeline for a pair of bus positions"""
+        position_pair = self._extract_position_pair(bus_positions, first_point_index, last_point_index)
+        corrected_positions = self._correct_positions(route_data, position_pair)
+        segment_distances = self._calculate_segment_distances(route_data, corrected_positions)
+        absolute_distances = self._calculate_absolute_distances(route_data, corrected_positions, segment_distances)
+        travel_metrics = self._calculate_travel_metrics(absolute_distances, position_pair)
+
+        return absolute_distances, travel_metrics
+
+    async def calculate_average_speed(self, bus_id: str, first_point_index: int,
+                                      last_point_index: int) -> tuple[float, datetime, float, np.ndarray, int]:
         """
         Calculate average speed between two bus positions.
 
         This method orchestrates the speed calculation process by delegating
-        specific responsibilities to focused helper methods.
+        specific responsibilities to focused helper methods. Route data (MySQL)
+        and bus positions (InfluxDB) are independent, so both are fetched concurrently.
+        The correction pipeline also runs in a worker thread so the event loop keeps
+        serving other requests meanwhile.
+
+        Results are cached for a few seconds keyed on the timestamp of the latest GPS fix,
+        so repeated predictions for the same bus skip the whole pipeline until a new fix arrives.
         """
         try:
-            route_data = self.get_route_data(bus_id)
-            bus_positions = self._get_bus_positions(bus_id)
-            position_pair = self._extract_position_pair(bus_positions, first_point_index, last_point_index)
-            corrected_positions = self._correct_positions(route_data, position_pair)
-            segment_distances = self._calculate_segment_distances(route_data, corrected_positions)
-            absolute_distances = self._calculate_absolute_distances(corrected_positions, segment_distances)
-            travel_metrics = self._calculate_travel_metrics(absolute_distances, position_pair)
-
-            return (
+            latest_position_time = await asyncio.to_thread(self.influxdb_manager.latest_position_time, bus_id)
+            cache_key = (bus_id, first_point_index, last_point_index, latest_position_time)
+            if latest_position_time is not None:
+                cached = self._speed_cache.get(cache_key)
+                if cached is not None:
+                    logger.info("Using cached average speed for bus %s", bus_id)
+                    return cached
+
+            route_data, bus_positions = await asyncio.gather(
+                asyncio.to_thread(self.get_route_data, bus_id),
+                asyncio.to_thread(self._get_bus_positions, bus_id, first_point_index, last_point_index)
+            )
+            absolute_distances, travel_metrics = await asyncio.to_thread(
+                self._calculate_route_travel, route_data, bus_positions, first_point_index, last_point_index
+            )
+
+            result = (
                 travel_metrics.average_speed,
                 travel_metrics.last_timestamp,
                 absolute_distances.last_point_distance,
                 route_data.distance_traveled_list,
                 route_data.bus_shape
             )
+            if latest_position_time is not None:
+                self._speed_cache[cache_key] = result
+
+            return result
 
         except Exception as e:
-            logger.error(f"Error calculating average speed: {e}")
+            logger.error("Error calculating average speed: %s", e)
             raise
 
-    def calculate_predicted_position(self, bus_id: str, prediction_seconds: int,
-                                     initial_index: int = 0, last_index: int = -1) -> Dict[str, Any]:
+    async def calculate_predicted_position(self, bus_id: str, prediction_seconds: int,
+                                           initial_index: int = 0, last_index: int = -1) -> Dict[str, Any]:
         try:
             # calculate time
-            speed, last_timestamp, absolute_last_point_distance, distance_traveled_list, bus_shape = self.calculate_average_speed(
+            speed, last_timestamp, absolute_last_point_distance, distance_traveled_list, bus_shape = await self.calculate_average_speed(
                 bus_id,
                 initial_index, last_index)
 
@@ -241,8 +300,10 @@ class PredictionService:
             absolute_distance_traveled_to_next_position = absolute_last_point_distance + distance_traveled_to_next_position
             left_distance, right_distance = find_surrounding_distances(distance_traveled_list,
                                                                        absolute_distance_traveled_to_next_position)
-            left_point = self.mysql_manager.get_coordinates(bus_shape, left_distance)
-            right_point = self.mysql_manager.get_coordinates(bus_shape, right_distance)
+            left_point, right_point = await asyncio.gather(
+                asyncio.to_thread(self.mysql_manager.get_coordinates, bus_shape, left_distance),
+                asyncio.to_thread(self.mysql_manager.get_coordinates, bus_shape, right_distance)
+            )
             latitude_predicted, longitude_predicted = interpolate_point(float(left_point[0]), float(left_point[1]),
                                                                         float(left_distance),
                                                                         float(right_point[0]), float(right_point[1]),
@@ -262,48 +323,44 @@ class PredictionService:
             }
 
         except Exception as e:
-            logger.error(f"Error calculating predicted position: {e}")
+            logger.error("Error calculating predicted position: %s", e)
             raise
 
-    def calculate_predicted_arrival_by_coords(self, bus_id: str, location: LocationRequest,
-                                              initial_index: int = 0, last_index: int = -1) -> Dict[str, Any]:
+    async def calculate_predicted_arrival_by_coords(self, bus_id: str, location: LocationRequest,
+                                                    initial_index: int = 0, last_index: int = -1) -> Dict[str, Any]:
         try:
             # calculate time
-            speed, last_timestamp, absolute_last_point_distance, distance_traveled_list, bus_shape = self.calculate_average_speed(
+            speed, last_timestamp, absolute_last_point_distance, distance_traveled_list, bus_shape = await self.calculate_average_speed(
                 bus_id,
                 initial_index, last_index)
-            route_data = self.get_route_data(bus_id)
+            route_data = await asyncio.to_thread(self.get_route_data, bus_id)
 
             # Predict time to achieve next position
             point_to_predict = (location.latitude, location.longitude)
-            point_to_predict_corrected, _, segment_to_predict = correct_position(route_data.route_coordinates,
-                                                                                 point_to_predict)
-
-            distance_traveled_segment_to_predict_point_a = self.mysql_manager.dist_traveled(bus_shape,
-                                                                                            segment_to_predict[0][0],
-                                                                                            segment_to_predict[0][1])
-            distance_traveled_segment_to_predict_point_b = self.mysql_manager.dist_traveled(bus_shape,
-                                                                                            segment_to_predict[1][0],
-                                                                                            segment_to_predict[1][1])
+            point_to_predict_corrected, _, segment_to_predict, segment_index = correct_position(route_data,
+                                                                                                point_to_predict)
+
+            distance_traveled_segment_to_predict_point_a = float(route_data.distance_traveled_list[segment_index])
+            distance_traveled_segment_to_predict_point_b = float(route_data.distance_traveled_list[segment_index + 1])
             distance_segment_to_predict = distance_traveled_segment_to_predict_point_b - distance_traveled_segment_to_predict_point_a
 
             distance_to_predict_relative = calculate_distance_along_route(
-                segment_to_predict[0], segment_to_predict[1], point_to_predict_corrected, distance_segment_to_predict
+                segment_to_predict[0], segment_to_predict[1], point_to_predict_corrected, distance_segment_to_predict,
+                float(route_data.seg_len[segment_index])
             )
 
             absolute_point_to_predict_distance = distance_traveled_segment_to_predict_point_a + distance_to_predict_relative
-            logger.info(f"Distance to predict: {absolute_point_to_predict_distance:.2f}m")
-
-            if absolute_point_to_predict_distance > absolute_last_point_distance:
-                if absolute_point_to_predict_distance < absolute_last_point_distance:
-                    raise HTTPException(status_code=400, detail=f"Point to predict distance in route "
-                                                                f"({absolute_point_to_predict_distance}m) is behind last "
-                                                                f"known point distance in route "
-                                                                f"({absolute_last_point_distance}m)")
+            logger.info("Distance to predict: %.2fm", absolute_point_to_predict_distance)
 
             distance_to_travel = absolute_point_to_predict_distance - absolute_last_point_distance
+            if distance_to_travel < 0:
+                raise HTTPException(status_code=400, detail=f"Point to predict distance in route "
+                                                            f"({absolute_point_to_predict_distance}m) is behind last "
+                                                            f"known point distance in route "
+                                                            f"({absolute_last_point_distance}m)")
+
             predicted_time = distance_to_travel / speed
-            logger.info(f"Predicted time: {predicted_time} secs or {predicted_time / 60} mins")
+            logger.info("Predicted time: %s secs or %s mins", predicted_time, predicted_time / 60)
 
             predicted_arrival_time = last_timestamp + timedelta(seconds=predicted_time)
 
@@ -316,14 +373,14 @@ class PredictionService:
             }
 
         except Exception as e:
-            logger.error(f"Error calculating arrival time: {e}")
+            logger.error("Error calculating arrival time: %s", e)
             raise
 
-    def calculate_predicted_arrival_time_by_distance(self, bus_id: str, distance_traveled: int,
-                                                     initial_index: int = 0, last_index: int = -1) -> Dict[str, Any]:
+    async def calculate_predicted_arrival_time_by_distance(self, bus_id: str, distance_traveled: int,
+                                                           initial_index: int = 0, last_index: int = -1) -> Dict[str, Any]:
         try:
             # calculate time
-            speed, last_timestamp, absolute_last_point_distance, distance_traveled_list, bus_shape = self.calculate_average_speed(
+            speed, last_timestamp, absolute_last_point_distance, distance_traveled_list, bus_shape = await self.calculate_average_speed(
                 bus_id,
                 initial_index, last_index)
 
@@ -339,8 +396,10 @@ class PredictionService:
             # calculate coords
             left_distance, right_distance = find_surrounding_distances(distance_traveled_list,
                                                                        distance_traveled)  # TODO: chequea que distance_traveled < max
-            left_point = self.mysql_manager.get_coordinates(bus_shape, left_distance)
-            right_point = self.mysql_manager.get_coordinates(bus_shape, right_distance)
+            left_point, right_point = await asyncio.gather(
+                asyncio.to_thread(self.mysql_manager.get_coordinates, bus_shape, left_distance),
+                asyncio.to_thread(self.mysql_manager.get_coordinates, bus_shape, right_distance)
+            )
             latitude_predicted, longitude_predicted = interpolate_point(float(left_point[0]), float(left_point[1]),
                                                                         float(left_distance),
                                                                         float(right_point[0]), float(right_point[1]),
@@ -360,15 +419,16 @@ class PredictionService:
             }
 
         except Exception as e:
-            logger.error(f"Error calculating arrival time: {e}")
+            logger.error("Error calculating arrival time: %s", e)
             raise
 
-    def calculate_predicted_arrival_time_by_stop(self, bus_id: str, stop_order: int,
-                                                 initial_index: int = 0, last_index: int = -1) -> Dict[str, Any]:
+    async def calculate_predicted_arrival_time_by_stop(self, bus_id: str, stop_order: int,
+                                                       initial_index: int = 0, last_index: int = -1) -> Dict[str, Any]:
         try:
-            route_info = self.influxdb_manager.get_bus_route(bus_id)
+            route_info = await asyncio.to_thread(self.influxdb_manager.get_bus_route, bus_id)
 
-            stops = self.influxdb_manager.get_stops_for_line_and_direction(route_info["linea"], route_info["sentido"])
+            stops = await asyncio.to_thread(self.influxdb_manager.get_stops_for_line_and_direction,
+                                            route_info["linea"], route_info["sentido"])
             stop = next((stop_dict for stop_dict in stops if stop_dict['orden'] == stop_order), None)
 
             if not stop:
@@ -381,7 +441,7 @@ class PredictionService:
                 longitude=stop["longitud"]
             )
 
-            result = self.calculate_predicted_arrival_by_coords(
+            result = await self.calculate_predicted_arrival_by_coords(
                 bus_id,
                 target_location
             )
@@ -391,15 +451,14 @@ class PredictionService:
             return result
 
         except Exception as e:
-            logger.error(f"Error calculating arrival time: {e}")
+            logger.error("Error calculating arrival time: %s", e)
             raise
 
-    def get_bus_details(self, bus_id: str) -> Any:
+    async def get_bus_details(self, bus_id: str) -> Any:
         """Get bus line details for the given bus ID"""
 
         # Line and direction
-        route_info = self.influxdb_manager.get_bus_route(bus_id)
-        route_data = self.get_route_data(bus_id)
+        route_info = await asyncio.to_thread(self.influxdb_manager.get_bus_route, bus_id)
         if not route_info.get('linea') or not route_info.get('sentido'):
             return None
         try:
@@ -408,26 +467,27 @@ class PredictionService:
         except (IndexError, TypeError):
             return None
 
-        # List of stops
-        stops = self.influxdb_manager.get_stops_for_line_and_direction(line_id, direction_id)
+        # Route, list of stops and positions are independent of each other
+        route_data, stops, positions = await asyncio.gather(
+            asyncio.to_thread(self.get_route_data, bus_id),
+            asyncio.to_thread(self.influxdb_manager.get_stops_for_line_and_direction, line_id, direction_id),
+            asyncio.to_thread(self.influxdb_manager.bus_positions, bus_id)
+        )
 
-        last_position = self.influxdb_manager.bus_positions(bus_id)[-1] # TODO: no data? exception
+        last_position = positions[-1] # TODO: no data? exception
 
         # Last distance traveled
         point_to_predict = (last_position["latitude"], last_position["longitude"])
-        point_to_predict_corrected, _, segment_to_predict = correct_position(route_data.route_coordinates,
-                                                                             point_to_predict)
-
-        distance_traveled_segment_to_predict_point_a = self.mysql_manager.dist_traveled(route_data.bus_shape,
-                                                                                        segment_to_predict[0][0],
-                                                                                        segment_to_predict[0][1])
-        distance_traveled_segment_to_predict_point_b = self.mysql_manager.dist_traveled(route_data.bus_shape,
-                                                                                        segment_to_predict[1][0],
-                                                                                        segment_to_predict[1][1])
+        point_to_predict_corrected, _, segment_to_predict, segment_index = correct_position(route_data,
+                                                                                            point_to_predict)
+
+        distance_traveled_segment_to_predict_point_a = float(route_data.distance_traveled_list[segment_index])
+        distance_traveled_segment_to_predict_point_b = float(route_data.distance_traveled_list[segment_index + 1])
         distance_segment_to_predict = distance_traveled_segment_to_predict_point_b - distance_traveled_segment_to_predict_point_a
 
         distance_to_predict_relative = calculate_distance_along_route(
-            segment_to_predict[0], segment_to_predict[1], point_to_predict_corrected, distance_segment_to_predict
+            segment_to_predict[0], segment_to_predict[1], point_to_predict_corrected, distance_segment_to_predict,
+            float(route_data.seg_len[segment_index])
         )
 
         absolute_point_to_predict_distance = distance_traveled_segment_to_predict_point_a + distance_to_predict_relative
@@ -439,5 +499,5 @@ class PredictionService:
             last_position=LocationRequest(latitude=point_to_predict_corrected[0],
                                           longitude=point_to_predict_corrected[1]),
             last_distance_traveled=absolute_point_to_predict_distance,
-            total_route_distance=route_data.distance_traveled_list[-1]
+            total_route_distance=int(route_data.distance_traveled_list[-1])
         )
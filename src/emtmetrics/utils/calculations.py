@@ -1,104 +1,109 @@
-from bisect import bisect
-from decimal import Decimal
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 
 import numpy as np
-from scipy.spatial import cKDTree
 from math import radians, sin, cos, sqrt, atan2
 import bisect
 
 from ..error.point_not_close_error import PointNotCloseError
+from ..model.prediction_service_aux_data import RouteData
+
+
+def precompute_segments(route: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Precomputes the per segment coefficients used by correct_position.
+
+    Args:
+        route: Array of shape (N, 2) with (lat, lon) points
+
+    Returns:
+        Tuple (origin_lat, origin_lon, dx, dy, inv_len2) of arrays with N - 1 elements, where
+        inv_len2 is 1 / (dx^2 + dy^2), or 0 for zero length segments
+    """
+    origin_lat = route[:-1, 0]
+    origin_lon = route[:-1, 1]
+    dx = route[1:, 0] - origin_lat
+    dy = route[1:, 1] - origin_lon
+
+    len2 = dx * dx + dy * dy
+    inv_len2 = np.divide(1, len2, out=np.zeros_like(len2), where=len2 != 0)
+
+    return origin_lat, origin_lon, dx, dy, inv_len2
 
 
 def correct_position(
-    route: list,
+    route_data: RouteData,
     bus_position: tuple[float, float],
     max_distance: float = 0.001
-) -> Tuple[tuple[float, float], float, tuple[tuple[float, float]]]:
+) -> Tuple[tuple[float, float], float, tuple[tuple[float, float]], int]:
     """
     Corrects the bus position to the closest point on the route.
-    Raises PointNotCloseError if the closest point is farther than max_distance.
+    Raises PointNotCloseError if the closest point is farther than max_distance,
+    and ValueError if the bus position has NaN or infinite coordinates.
 
     Args:
-        route: List of (lat, lon) points
-        bus_position: Dict with 'latitude' and 'longitude' or tuple (lat, lon)
+        route_data: Route with its search coordinates, optional search tree and segment coefficients
+        bus_position: Dict with 'latitude' and 'longitude', record with 'lat' and 'lon' or tuple (lat, lon)
         max_distance: Maximum allowed distance to consider the point close
 
     Returns:
         best_point: Closest point on the route (lon, lat)
         best_distance: Distance to the closest point
         best_segment: Segment (p1, p2) where the closest point lies
+        segment_index: Index of p1 in the route, p2 is the next point
     """
-    route_float = []
-    for point in route:
-        lat = point[0]
-        lon = point[1]
-        if isinstance(lat, Decimal):
-            lat = float(lat)
-        if isinstance(lon, Decimal):
-            lon = float(lon)
-        route_float.append((lat, lon))
-
     if isinstance(bus_position, dict):
         lon = float(bus_position['longitude'])
         lat = float(bus_position['latitude'])
         pos_float = (lat, lon)
+    elif isinstance(bus_position, np.void):
+        # Record of InfluxDBManager.bus_positions_array
+        pos_float = (float(bus_position['lat']), float(bus_position['lon']))
     else:
         lat = float(bus_position[0])
         lon = float(bus_position[1])
         pos_float = (lat, lon)
 
-    tree = cKDTree(route_float)
-    distances, indices = tree.query(pos_float, k=2)
-
-    segments = []
-    for idx in indices:
-        if idx > 0:
-            segments.append((route_float[idx - 1], route_float[idx]))
-        if idx < len(route_float) - 1:
-            segments.append((route_float[idx], route_float[idx + 1]))
+    # Checked up front as cKDTree.query does, the scan below would silently match segment 0 with a NaN distance
+    if not np.isfinite(pos_float).all():
+        raise ValueError(f"Bus position {pos_float} must be finite, check for nan or inf values")
 
-    segments = list(set(segments))
-
-    best_distance = float('inf')
-    best_point = None
-    best_segment = None
-
-    for p1, p2 in segments:
-        p1_arr = np.array(p1)
-        p2_arr = np.array(p2)
-        pos_arr = np.array(pos_float)
-
-        v = p2_arr - p1_arr
-        w = pos_arr - p1_arr
+    if route_data.search_tree is not None:
+        _, indices = route_data.search_tree.query(pos_float, k=2)
+    else:
+        # A single query does not amortize building a tree, scan for the two closest points instead
+        offsets = route_data.search_coordinates - np.asarray(pos_float, dtype=route_data.search_coordinates.dtype)
+        d2 = (offsets * offsets).sum(axis=1)
+        indices = np.argpartition(d2, 1)[:2] if len(d2) > 2 else np.arange(len(d2))
 
-        c = np.dot(w, v)
-        b = np.dot(v, v)
+    # Segments adjacent to the two closest route points
+    n_segments = len(route_data.seg_dx)
+    candidates = np.unique(np.clip(np.concatenate((indices - 1, indices)), 0, n_segments - 1))
 
-        if b == 0:
-            dist = np.linalg.norm(w)
-            if dist < best_distance:
-                best_distance = dist
-                best_point = p1
-                best_segment = (p1, p2)
-            continue
+    pos = np.asarray(pos_float, dtype=route_data.seg_dx.dtype)
+    origin_lat = route_data.seg_origin_lat[candidates]
+    origin_lon = route_data.seg_origin_lon[candidates]
+    dx = route_data.seg_dx[candidates]
+    dy = route_data.seg_dy[candidates]
 
-        t = max(0, min(1, c / b))
-        point_proy = p1_arr + t * v
-        dist = np.linalg.norm(pos_arr - point_proy)
+    w_lat = pos[0] - origin_lat
+    w_lon = pos[1] - origin_lon
+    t = np.clip((dx * w_lat + dy * w_lon) * route_data.seg_inv_len2[candidates], 0, 1)
+    dists = np.hypot(w_lat - t * dx, w_lon - t * dy)
 
-        if dist < best_distance:
-            best_distance = dist
-            best_point = tuple(point_proy)
-            best_segment = (p1, p2)
+    best = int(np.argmin(dists))
+    best_distance = float(dists[best])
 
     if best_distance > max_distance:
         raise PointNotCloseError(
             f"Point is too far from route: distance {best_distance} > max allowed {max_distance}"
         )
 
-    best_point = (float(best_point[0]), float(best_point[1]))
-    return best_point, float(best_distance), best_segment
+    segment_index = int(candidates[best])
+    best_point = (float(origin_lat[best] + t[best] * dx[best]), float(origin_lon[best] + t[best] * dy[best]))
+    p1 = route_data.route_coordinates[segment_index]
+    p2 = route_data.route_coordinates[segment_index + 1]
+    best_segment = ((float(p1[0]), float(p1[1])), (float(p2[0]), float(p2[1])))
+    return best_point, best_distance, best_segment, segment_index
 
 
 def haversine(lon1: float, lat1: float, lon2: float, lat2: float) -> float:
@@ -111,11 +116,36 @@ def haversine(lon1: float, lat1: float, lon2: float, lat2: float) -> float:
     return 6371000 * c  # Earth radius in meters
 
 
+def haversine_many(lon1: np.ndarray, lat1: np.ndarray, lon2: np.ndarray, lat2: np.ndarray) -> np.ndarray:
+    """Elementwise haversine over arrays of points, same formula and units as haversine."""
+    lon1, lat1, lon2, lat2 = (np.radians(np.asarray(v, dtype=np.float64)) for v in (lon1, lat1, lon2, lat2))
+    dlon = lon2 - lon1
+    dlat = lat2 - lat1
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+    return 6371000 * c
+
+
+def segment_lengths(route: np.ndarray) -> np.ndarray:
+    """
+    Precomputes the straight length of every route segment, as calculate_distance_along_route measures it.
+
+    Args:
+        route: Array of shape (N, 2) with route points, in the same order as the points passed to
+            calculate_distance_along_route
+
+    Returns:
+        Array with N - 1 segment lengths in meters
+    """
+    return haversine_many(route[:-1, 0], route[:-1, 1], route[1:, 0], route[1:, 1])
+
+
 def calculate_distance_along_route(
         a: tuple[float, float],
         b: tuple[float, float],
         p: tuple[float, float],
-        d_ab: float
+        d_ab: float,
+        d_ab_straight: Optional[float] = None
 ) -> float:
     """Calculate distance traveled from a to p along the route.
 
@@ -124,12 +154,14 @@ def calculate_distance_along_route(
         b: (longitude, latitude) of end point.
         p: (longitude, latitude) of intermediate point.
         d_ab: Total route distance from a to b (meters).
+        d_ab_straight: Precomputed straight distance from a to b (meters), see segment_lengths.
 
     Returns:
         Distance from a to p along the route (meters).
     """
     d_ap = haversine(a[0], a[1], p[0], p[1])
-    d_ab_straight = haversine(a[0], a[1], b[0], b[1])
+    if d_ab_straight is None:
+        d_ab_straight = haversine(a[0], a[1], b[0], b[1])
 
     if d_ab_straight == 0:  # Avoid division by zero
         return 0.0
@@ -143,7 +175,7 @@ def find_surrounding_distances(distances: List[float], target: float) -> Tuple[f
     Finds the two consecutive distances in a sorted list that surround a target value.
 
     Args:
-        distances: Sorted list of distances in ascending order
+        distances: Sorted list or array of distances in ascending order
         target: Target distance value to locate
 
     Returns:
@@ -152,28 +184,22 @@ def find_surrounding_distances(distances: List[float], target: float) -> Tuple[f
     Raises:
         ValueError: If the list is empty or target is out of range
     """
-    if not distances:
+    if len(distances) == 0:
         raise ValueError("Distance list cannot be empty")
 
-    n = len(distances)
-
     # Check if target is out of range
     if target < distances[0]:
         raise ValueError(f"Target {target} is below minimum distance {distances[0]}")
     if target > distances[-1]:
         raise ValueError(f"Target {target} is above maximum distance {distances[-1]}")
 
-    # Find insertion position using binary search
-    idx = bisect.bisect_left(distances, target)
-
-    # Handle exact matches and edge cases
-    if idx == 0:
-        return distances[0], distances[0]
-    if distances[idx] == target or idx == n:
-        return distances[idx - 1], distances[idx] if idx < n else distances[-1]
+    # Find insertion position using binary search, idx >= 1 because target >= distances[0]
+    if isinstance(distances, np.ndarray):
+        idx = int(np.searchsorted(distances, target, side='right'))
+    else:
+        idx = bisect.bisect_right(distances, target)
 
-    # Return surrounding distances
-    return distances[idx - 1], distances[idx]
+    return distances[idx - 1], distances[min(idx, len(distances) - 1)]
 
 
 def interpolate_point(
@@ -220,3 +246,35 @@ def interpolate_point(
     lon_p = lon_a + fraction * (lon_b - lon_a)
 
     return lat_p, lon_p
+
+
+def interpolate_points(
+        lat_a: np.ndarray, lon_a: np.ndarray, dist_a: np.ndarray,
+        lat_b: np.ndarray, lon_b: np.ndarray, dist_b: np.ndarray,
+        dist_p: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Batched version of interpolate_point, every argument is an array of the same length.
+
+    Returns:
+        Tuple (lat_p, lon_p) of arrays with the interpolated coordinates
+
+    Raises:
+        ValueError: If any dist_p is not between its dist_a and dist_b
+    """
+    lat_a, lon_a, dist_a, lat_b, lon_b, dist_b, dist_p = (
+        np.asarray(v, dtype=np.float64) for v in (lat_a, lon_a, dist_a, lat_b, lon_b, dist_b, dist_p)
+    )
+
+    if not np.all((dist_a <= dist_p) & (dist_p <= dist_b)):
+        raise ValueError("dist_p must be between dist_a and dist_b")
+
+    # Coincident points get a zero fraction, so they resolve to point A
+    span = dist_b - dist_a
+    coincident = span == 0
+    fraction = np.where(coincident, 0.0, (dist_p - dist_a) / np.where(coincident, 1.0, span))
+
+    lat_p = lat_a + fraction * (lat_b - lat_a)
+    lon_p = lon_a + fraction * (lon_b - lon_a)
+
+    return lat_p, lon_p
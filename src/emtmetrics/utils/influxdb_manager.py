@@ -1,34 +1,172 @@
 from influxdb_client import InfluxDBClient, QueryApi
 from influxdb_client.client.exceptions import InfluxDBError
 import logging
-from typing import List, Dict, Any, Optional, Tuple
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Callable, List, Dict, Any, Iterable, Iterator, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from .ttl_cache import TTLCache
+
+
+logger = logging.getLogger(__name__)
+
+# Result columns of the positions queries, already named as in the returned positions
+POSITION_COLUMNS = ["time", "latitude", "longitude"]
+
+# Line fields of the positions query, a change in any of them starts a new route
+ROUTE_COLUMNS = ["code", "direction"]
+
+STOP_COLUMNS = ["codParada", "orden", "latitud", "longitud"]
+
+# Thing IDs such as "buses:712"
+_BUS_ID_RE = re.compile(r'\A[A-Za-z0-9_.-]+:[A-Za-z0-9_.-]+\Z')
+
+# Record layout of bus_positions_array and column types of bus_positions_columns, times are UTC.
+# float32 coordinates resolve ~4e-6 degrees (~0.4 m) at these latitudes, finer than GPS accuracy
+POSITION_DTYPE = np.dtype([('time', 'datetime64[ns]'), ('lat', 'f4'), ('lon', 'f4')])
+
+# Default history scanned by the positions queries
+POSITIONS_WINDOW = timedelta(hours=2)
+
+# Ranges tried in turn by the last value queries until every field is found. Most buses report
+# within minutes, so the common case scans a fraction of a day
+LAST_VALUES_WINDOWS = (timedelta(minutes=10), timedelta(days=1), timedelta(days=7))
+
+# Ranges tried in turn by the stops query. A stop missing from a range would silently drop out of the
+# join, so it starts at a full day and only widens when nothing is found
+STOPS_WINDOWS = (timedelta(days=1), timedelta(days=7))
 
 
 class InfluxDBManager:
-    def __init__(self, url: str, org: str, token: str, bucket: str = "default"):
+    def __init__(self, url: str, org: str, token: str, bucket: str = "default", max_workers: int = 8,
+                 stops_cache_ttl: float = 3600, route_cache_ttl: float = 5, missing_route_cache_ttl: float = 60):
         """
         Simplified InfluxDB manager
 
         :param url: InfluxDB server URL
         :param org: Organization name
         :param bucket: Bucket name (default: "default")
+        :param max_workers: Threads used by warmup to query stops concurrently (default: 8)
+        :param stops_cache_ttl: Seconds the stops of a line and direction are cached (default: 3600)
+        :param route_cache_ttl: Seconds the line and direction of a bus are cached (default: 5)
+        :param missing_route_cache_ttl: Seconds a bus without line or direction is remembered, so unknown
+                                        buses don't repeat the widening route lookup (default: 60)
         """
         self.url = url
         self.org = org
         self.token = token
         self.bucket = bucket
+        self._client: Optional[InfluxDBClient] = None
+        self._query_api: Optional[QueryApi] = None
+        self._client_lock = threading.Lock()
+        self.max_workers = max_workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+        # Stops only change with the line definitions, (line, sentido) -> stops
+        self._stops_cache = TTLCache(maxsize=512, ttl=stops_cache_ttl)
+        # Buses are polled often but rarely change line or direction, bus_id -> route
+        self._route_cache = TTLCache(maxsize=4096, ttl=route_cache_ttl)
+        # Buses whose route was not found in any range, bus_id -> incomplete route
+        self._missing_route_cache = TTLCache(maxsize=4096, ttl=missing_route_cache_ttl)
 
+    def __enter__(self) -> "InfluxDBManager":
+        return self
 
-    def _execute_query(self, query: str) -> Any:
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Close the client, its HTTP connection pool and the query threads, they are created again if needed"""
+        with self._client_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+            if self._client is not None:
+                self._client.close()
+            self._executor = None
+            self._client = None
+            self._query_api = None
+
+    def clear_stops_cache(self) -> None:
+        """Forget the cached stops, so they are queried again"""
+        self._stops_cache.clear()
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        """Create the thread pool used by warmup on first use"""
+        if self._executor is None:
+            with self._client_lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                        thread_name_prefix="influxdb-query")
+        return self._executor
+
+    def _get_query_api(self) -> QueryApi:
+        """Create the client on first use, it is shared by all queries so HTTP connections are reused"""
+        if self._query_api is None:
+            with self._client_lock:
+                if self._query_api is None:
+                    # Query responses are CSV, which compresses well
+                    self._client = InfluxDBClient(url=self.url, token=self.token, org=self.org, enable_gzip=True)
+                    self._query_api = self._client.query_api()
+        return self._query_api
+
+
+    def _params(self, **values: Any) -> Dict[str, Any]:
+        """
+        Build the parameters of a query. Values are sent as Flux options instead of being formatted into the
+        query, so the query text stays the same across buses and lines and cannot be injected into.
+
+        :param values: Parameters used by the query besides bucketName
+        :return: Query parameters
+        """
+        return {'bucketName': self.bucket, **values}
+
+    def _execute_query(self, query: str, params: Optional[Dict[str, Any]] = None) -> Any:
         """
         Execute a Flux query and return raw tables
 
         :param query: Flux query string
+        :param params: Query parameters, see _params
         :return: Query result tables
         """
-        with InfluxDBClient(url=self.url, token=self.token, org=self.org) as client:
-            query_api = client.query_api()
-            return query_api.query(query=query, org=self.org)
+        return self._get_query_api().query(query=query, org=self.org, params=params)
+
+    def _query_data_frame(self, query: str, params: Optional[Dict[str, Any]] = None) -> pd.DataFrame:
+        """
+        Execute a Flux query and parse its result into a single DataFrame
+
+        :param query: Flux query string
+        :param params: Query parameters, see _params
+        :return: DataFrame with all result tables, empty if there are none
+        """
+        frames = self._get_query_api().query_data_frame(query=query, org=self.org, params=params)
+        # A DataFrame is returned for each distinct table schema
+        if isinstance(frames, list):
+            return pd.concat(frames, ignore_index=True)
+        return frames
+
+    def _query_with_window_fallback(self, run: Callable[[str, Dict[str, Any]], Any], query: str,
+                                    params: Dict[str, Any], windows: Sequence[timedelta],
+                                    found: Callable[[Any], bool]) -> Any:
+        """
+        Run a query over increasingly wider ranges until its result is found
+
+        :param run: Query runner, _execute_query or _query_data_frame
+        :param query: Flux query string, its range starts at rangeStart
+        :param params: Query parameters, see _params
+        :param windows: Ranges to try, narrowest first
+        :param found: Whether a result is complete, otherwise the next range is tried
+        :return: Result of the first range where it was found, or of the widest one
+        """
+        result = None
+        for window in windows:
+            result = run(query, {**params, 'rangeStart': -window})
+            if found(result):
+                break
+        return result
 
     def get_stops_for_line_and_direction(self, line: str, sentido: str) -> List[Dict[str, Any]]:
         """
@@ -41,141 +179,322 @@ class InfluxDBManager:
         Returns:
             List of dictionaries with keys: codParada, orden, latitud, longitud
         """
-        flux_query = f'''
-        import "strings"
-    
-        linea =
-          from(bucket: "{self.bucket}")
-              |> range(start: -1d)
-              |> filter(fn: (r) => r["_measurement"] == "mqtt_consumer")
-              |> filter(fn: (r) => r["_field"] =~ /^value_stops_properties_\\d+_(orden|sentido)$/)
-              |> filter(fn: (r) => r["thingId"] == "lines:{line}")
-              |> last()
-              |> map(fn: (r) => ({{
-            codLinea: r["thingId"],
-                  codParada: strings.split(v: r._field, t: "_")[3],
-                  tipo: strings.split(v: r._field, t: "_")[4],
-                  valor: r._value,
-                  _time: r._time
-                }}))
-              |> pivot(rowKey: ["_time", "codLinea", "codParada"], columnKey: ["tipo"], valueColumn: "valor")
-              |> filter(fn: (r) => exists r.sentido and string(v: r.sentido) == "{sentido}")
-              |> map(fn: (r) => ({{
-            codParada: r.codParada,
-                  orden: int(v: r.orden)
-                }}))
-              |> sort(columns: ["orden"], desc: false)
-    
-        paradas =
-          from(bucket: "{self.bucket}")
-            |> range(start: -1d)
-            |> filter(fn: (r) => r["_measurement"] == "mqtt_consumer")
-            |> filter(fn: (r) => r["_field"] =~ /^value_stop_properties_latitud$/ or r["_field"] =~ /^value_stop_properties_longitud$/)
-            |> last()
-            |> map(fn: (r) => ({{
-            codParada: strings.trimPrefix(v: r["thingId"], prefix: "stops:"),
-                tipo: if r["_field"] =~ /^value_stop_properties_latitud$/ then "latitud" else "longitud",
-                valor: r._value,
-                _time: r._time
-              }}))
-            |> pivot(rowKey: ["_time", "codParada"], columnKey: ["tipo"], valueColumn: "valor")
-    
-        join(
-          tables: {{linea: linea, paradas: paradas}},
-          on: ["codParada"]
-        )
-          |> map(fn: (r) => ({{
-            codParada: r.codParada,
-              orden: r.orden,
-              latitud: float(v: r.latitud),
-              longitud: float(v: r.longitud)
-            }}))
-          |> sort(columns: ["orden"], desc: false)
-          |> yield(name: "ParadasConCoordenadas")
-            '''
+        cached = self._stops_cache.get((line, sentido))
+        if cached is not None:
+            return cached
+
         try:
-            tables = self._execute_query(flux_query)
-            stops = []
-            for table in tables:
-                for record in table.records:
-                    stops.append({
-                        "codParada": record.values.get("codParada"),
-                        "orden": record.values.get("orden"),
-                        "latitud": record.values.get("latitud"),
-                        "longitud": record.values.get("longitud"),
-                    })
+            df = self._query_with_window_fallback(
+                self._query_data_frame, self._build_stops_query(), self._params(lineId=line, direction=sentido),
+                STOPS_WINDOWS, lambda result: not result.empty
+            )
+            stops = [] if df.empty else df.reindex(columns=STOP_COLUMNS).to_dict(orient='records')
+            # Empty results are not cached, so a failed or premature lookup is retried
+            if stops:
+                self._stops_cache[(line, sentido)] = stops
             return stops
         except InfluxDBError as e:
-            logging.error(f"Failed to fetch stops for line {line}, sentido {sentido}: {e}")
+            logger.error("Failed to fetch stops for line %s, sentido %s: %s", line, sentido, e)
             return []
         except Exception as e:
-            logging.exception("Unexpected error in get_stops_for_line_and_direction")
+            logger.exception("Unexpected error in get_stops_for_line_and_direction")
             return []
 
-    def bus_positions(self, bus_id: str) -> List[Dict[str, Any]]:
+    def warmup(self, pairs: Iterable[Tuple[str, str]]) -> int:
+        """
+        Preload the stops cache for the given lines and directions, querying them in the thread pool
+
+        :param pairs: (line, sentido) pairs
+        :return: Number of pairs with stops
+        """
+        stops = self._get_executor().map(lambda pair: self.get_stops_for_line_and_direction(*pair), pairs)
+        return sum(1 for pair_stops in stops if pair_stops)
+
+    def bus_positions(self, bus_id: str, resolution_seconds: int = 1,
+                      window: timedelta = POSITIONS_WINDOW) -> List[Dict[str, Any]]:
         """
         Retrieve bus position data from InfluxDB
         """
+        return self.bus_positions_many([bus_id], resolution_seconds, window).get(bus_id, [])
+
+    def iter_bus_positions(self, bus_id: str, resolution_seconds: int = 1,
+                           window: timedelta = POSITIONS_WINDOW) -> Iterator[Dict[str, Any]]:
+        """
+        Stream bus position data from InfluxDB one position at a time, so consumers that aggregate as they go
+        never hold the whole series. Unlike bus_positions, positions are yielded newest first, which lets the
+        stream end as soon as the current route does.
+
+        :param bus_id: Bus identifier
+        :param resolution_seconds: Keep only the last sample in each window of this many seconds, 0 keeps all of them
+        :param window: History to retrieve (default: 2 hours)
+        :return: Iterator of position dicts of the current route, newest first
+        """
         # Validate input
         if not self._valid_bus_id(bus_id):
-            return []
+            return
+
+        try:
+            records = self._get_query_api().query_stream(
+                query=self._build_positions_query(1, resolution_seconds > 0), org=self.org,
+                params=self._positions_params([bus_id], resolution_seconds, window)
+            )
+            # Same segmentation as _current_route_positions, a missing value never counts as a change
+            current_route = dict.fromkeys(ROUTE_COLUMNS)
+            for record in records:
+                row = record.values
+                for column in ROUTE_COLUMNS:
+                    value = row.get(column)
+                    if value is None:
+                        continue
+                    if current_route[column] is None:
+                        current_route[column] = value
+                    elif value != current_route[column]:
+                        return
+                if row.get('time') is not None:
+                    yield {column: row.get(column) for column in POSITION_COLUMNS}
+        except InfluxDBError as e:
+            logger.error("Position query failed: %s", e)
+        except Exception as e:
+            logger.exception("Unexpected error in iter_bus_positions")
+
+    def bus_positions_many(self, bus_ids: List[str], resolution_seconds: int = 1,
+                           window: timedelta = POSITIONS_WINDOW) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        Retrieve position data of several buses from InfluxDB with a single query
+
+        :param bus_ids: Bus identifiers
+        :param resolution_seconds: Keep only the last sample in each window of this many seconds, 0 keeps all of them
+        :param window: History to retrieve (default: 2 hours)
+        :return: Positions of each bus keyed by bus ID, empty for invalid IDs or buses without data
+        """
+        positions = {bus_id: [] for bus_id in bus_ids}
+
+        # Validate input
+        valid_ids = [bus_id for bus_id in positions if self._valid_bus_id(bus_id)]
+        if not valid_ids:
+            return positions
 
         try:
             # Build and execute query
-            query = self._build_positions_query(bus_id)
-            tables = self._execute_query(query)
+            query = self._build_positions_query(len(valid_ids), resolution_seconds > 0)
+            df = self._query_data_frame(query, self._positions_params(valid_ids, resolution_seconds, window))
+            if 'thingId' in df:
+                for bus_id, bus_df in df.groupby('thingId', sort=False):
+                    if bus_id in positions:
+                        positions[bus_id] = self._process_positions(bus_df)
+            return positions
+        except InfluxDBError as e:
+            logger.error("Position query failed: %s", e)
+            return {bus_id: [] for bus_id in bus_ids}
+        except Exception as e:
+            logger.exception("Unexpected error in bus_positions_many")
+            return {bus_id: [] for bus_id in bus_ids}
+
+    def bus_positions_columns(self, bus_id: str, resolution_seconds: int = 1,
+                              window: timedelta = POSITIONS_WINDOW) -> Dict[str, np.ndarray]:
+        """
+        Retrieve bus position data from InfluxDB as one array per column, a compact alternative to bus_positions
 
-            # Process results
-            return self._process_positions(tables)
+        :param bus_id: Bus identifier
+        :param resolution_seconds: Keep only the last sample in each window of this many seconds, 0 keeps all of them
+        :param window: History to retrieve (default: 2 hours)
+        :return: Dict with 'time' (datetime64[ns], UTC), 'lat' and 'lon' (float32) arrays ordered by time,
+                 missing coordinates are NaN
+        """
+        empty = {name: np.empty(0, dtype=POSITION_DTYPE[name]) for name in POSITION_DTYPE.names}
+
+        # Validate input
+        if not self._valid_bus_id(bus_id):
+            return empty
+
+        try:
+            query = self._build_positions_query(1, resolution_seconds > 0)
+            df = self._query_data_frame(query, self._positions_params([bus_id], resolution_seconds, window))
+            if df.empty or 'time' not in df:
+                return empty
+
+            df = self._current_route_positions(df).reindex(columns=POSITION_COLUMNS)
+            columns = {
+                'time': pd.to_datetime(df['time'], utc=True).dt.tz_localize(None).to_numpy('datetime64[ns]'),
+                'lat': df['latitude'].to_numpy(POSITION_DTYPE['lat'], na_value=np.nan),
+                'lon': df['longitude'].to_numpy(POSITION_DTYPE['lon'], na_value=np.nan)
+            }
+            return {name: np.ascontiguousarray(values) for name, values in columns.items()}
+        except InfluxDBError as e:
+            logger.error("Position query failed: %s", e)
+            return empty
+        except Exception as e:
+            logger.exception("Unexpected error in bus_positions_columns")
+            return empty
+
+    def bus_positions_array(self, bus_id: str, resolution_seconds: int = 1,
+                            window: timedelta = POSITIONS_WINDOW) -> np.ndarray:
+        """
+        Retrieve bus position data from InfluxDB as a structured array, see bus_positions_columns
+
+        :param bus_id: Bus identifier
+        :param resolution_seconds: Keep only the last sample in each window of this many seconds, 0 keeps all of them
+        :param window: History to retrieve (default: 2 hours)
+        :return: Array of POSITION_DTYPE ordered by time, missing coordinates are NaN
+        """
+        columns = self.bus_positions_columns(bus_id, resolution_seconds, window)
+        positions = np.empty(len(columns['time']), dtype=POSITION_DTYPE)
+        for name, values in columns.items():
+            positions[name] = values
+        return positions
+
+    def first_and_last_positions(self, bus_id: str) -> List[Dict[str, Any]]:
+        """
+        Retrieve only the first and last positions of the bus's current route from InfluxDB
+        """
+        # Validate input
+        if not self._valid_bus_id(bus_id):
+            return []
+
+        try:
+            query = self._build_first_and_last_positions_query()
+            df = self._query_data_frame(query, self._positions_params([bus_id]))
+            return [] if df.empty else self._position_records(df)
         except InfluxDBError as e:
-            logging.error(f"Position query failed: {e}")
+            logger.error("First and last positions query failed: %s", e)
             return []
         except Exception as e:
-            logging.exception("Unexpected error in bus_positions")
+            logger.exception("Unexpected error in first_and_last_positions")
             return []
 
     def get_bus_route(self, bus_id: str) -> Dict[str, Optional[str]]:
         """
         Get current route information for a bus
         """
+        if not self._valid_bus_id(bus_id):
+            return {'linea': None, 'sentido': None}
+
+        cached = self._route_cache.get(bus_id) or self._missing_route_cache.get(bus_id)
+        if cached is not None:
+            return dict(cached)
+
         try:
-            # Get route components
-            linea = self._get_last_value(bus_id, "value_line_properties_code", "linea")
-            sentido = self._get_last_value(bus_id, "value_line_properties_direction", "sentido")
-            return {'linea': linea, 'sentido': sentido}
+            # Get both route components in a single query
+            field_names = ["value_line_properties_code", "value_line_properties_direction"]
+            tables = self._query_with_window_fallback(
+                self._execute_query, self._build_last_values_query(field_names), self._params(busId=bus_id),
+                LAST_VALUES_WINDOWS, lambda result: len(self._last_values(result)) == len(field_names)
+            )
+            values = self._last_values(tables)
+
+            route = {
+                'linea': values.get("value_line_properties_code"),
+                'sentido': values.get("value_line_properties_direction")
+            }
+            # Incomplete routes are kept apart, long enough to stop unknown buses from querying every range
+            # on each request, yet short enough for a bus that starts reporting to be picked up soon
+            if route['linea'] is not None and route['sentido'] is not None:
+                self._route_cache[bus_id] = route
+            else:
+                self._missing_route_cache[bus_id] = route
+            return dict(route)
         except InfluxDBError as e:
-            logging.error(f"Route query failed: {e}")
+            logger.error("Route query failed: %s", e)
             return {'linea': None, 'sentido': None}
         except Exception as e:
-            logging.exception("Unexpected error in get_bus_route")
+            logger.exception("Unexpected error in get_bus_route")
             return {'linea': None, 'sentido': None}
 
-    def _get_last_value(self, bus_id: str, field: str, alias: str) -> Optional[str]:
+    def latest_position_time(self, bus_id: str) -> Optional[datetime]:
         """
-        Get last value for a specific field
+        Get the timestamp of the latest GPS fix of a bus
         """
-        query = self._build_last_value_query(bus_id, field)
-        tables = self._execute_query(query)
+        if not self._valid_bus_id(bus_id):
+            return None
 
-        # Extract value from results
+        try:
+            tables = self._execute_query(self._build_latest_position_time_query(),
+                                         self._params(busId=bus_id, rangeStart=-POSITIONS_WINDOW))
+            for table in tables:
+                for record in table.records:
+                    return record.values.get('_time')
+            return None
+        except InfluxDBError as e:
+            logger.error("Latest position time query failed: %s", e)
+            return None
+        except Exception as e:
+            logger.exception("Unexpected error in latest_position_time")
+            return None
+
+    def _last_values(self, tables: Any) -> Dict[str, Any]:
+        """Collect the result of _build_last_values_query into a dict of field -> value"""
+        values = {}
         for table in tables:
             for record in table.records:
-                return record.values.get('valor')
-        return None
+                values.setdefault(record.values.get('_field'), record.values.get('valor'))
+        return values
 
-    def _build_positions_query(self, bus_id: str) -> str:
-        """Build positions query"""
+    def _positions_params(self, bus_ids: List[str], resolution_seconds: int = 1,
+                          window: timedelta = POSITIONS_WINDOW) -> Dict[str, Any]:
+        """Build the parameters of the positions queries, see _bus_ids_filter for how bus IDs are passed"""
+        if len(bus_ids) == 1:
+            bus_id_params = {'busId': bus_ids[0]}
+        else:
+            bus_id_params = {f'busId{i}': bus_id for i, bus_id in enumerate(bus_ids)}
+        return self._params(**bus_id_params, windowEvery=timedelta(seconds=max(resolution_seconds, 1)),
+                            rangeStart=-window)
+
+    def _bus_ids_filter(self, bus_count: int) -> str:
+        """
+        Build the Flux predicate matching the buses of the positions queries, busId for a single bus or
+        busId0, busId1... for several. Each ID is compared with == rather than contains(), so the filter is
+        pushed down to storage.
+        """
+        if bus_count == 1:
+            return 'r["thingId"] == busId'
+        return " or ".join(f'r["thingId"] == busId{i}' for i in range(bus_count))
+
+    def _build_raw_positions_query(self, bus_count: int = 1, downsample: bool = True) -> str:
+        """
+        Build query for the pivoted GPS and line fields of bus_count buses since rangeStart, each bus in its
+        own table. If downsample is set only the last sample in each windowEvery is kept.
+        """
+        # Down-sample server side keeping the last real sample of each window, unlike aggregateWindow
+        # this preserves the original timestamps, which the speed calculations depend on. It goes right
+        # after the filters, before any map, so storage can apply window and last itself
+        downsample_stage = '|> window(every: windowEvery) |> last() |> window(every: inf)' if downsample else ''
         return f'''
-            from(bucket: "{self.bucket}")
-                |> range(start: -2h)
+            from(bucket: bucketName)
+                |> range(start: rangeStart)
                 |> filter(fn: (r) => r["_measurement"] == "mqtt_consumer")
+                |> filter(fn: (r) => {self._bus_ids_filter(bus_count)})
                 |> filter(fn: (r) => r["_field"] == "value_gps_properties_longitude" or 
                                      r["_field"] == "value_gps_properties_latitude" or 
                                      r["_field"] == "value_line_properties_direction" or 
                                      r["_field"] == "value_line_properties_code")
-                |> filter(fn: (r) => r["thingId"] == "{bus_id}")
+                {downsample_stage}
                 |> map(fn: (r) => ({{ r with _value: float(v: r._value) }}))
                 |> pivot(rowKey: ["_time"], columnKey: ["_field"], valueColumn: "_value")
+        '''
+
+    def _build_positions_query(self, bus_count: int = 1, downsample: bool = True) -> str:
+        """Build positions query, newest first and with the line fields, see _current_route_positions"""
+        return f'''
+            {self._build_raw_positions_query(bus_count, downsample)}
+                |> keep(columns: ["_time", "thingId", "value_gps_properties_latitude", "value_gps_properties_longitude",
+                                  "value_line_properties_code", "value_line_properties_direction"])
+                |> rename(columns: {{
+                    _time: "time",
+                    value_gps_properties_latitude: "latitude",
+                    value_gps_properties_longitude: "longitude",
+                    value_line_properties_code: "code",
+                    value_line_properties_direction: "direction"
+                }})
+                |> sort(columns: ["time"], desc: true)
+        '''
+
+    def _build_first_and_last_positions_query(self) -> str:
+        """
+        Build first and last positions query, a single row is returned if both are the same.
+        The current route is segmented server side here, so only two rows are sent back.
+        """
+        return f'''
+            positions = {self._build_raw_positions_query()}
                 |> sort(columns: ["_time"], desc: true)
                 |> duplicate(column: "value_line_properties_code", as: "temp_code")
                 |> duplicate(column: "value_line_properties_direction", as: "temp_direction")
@@ -187,43 +506,138 @@ class InfluxDBManager:
                     changeGroup: if r.temp_code != 0.0 or r.temp_direction != 0.0 then 1 else 0
                 }}))
                 |> cumulativeSum(columns: ["changeGroup"])
-                |> keep(columns: ["_time", "value_gps_properties_latitude", "value_gps_properties_longitude", "changeGroup"])
                 |> filter(fn: (r) => r.changeGroup == 0)
-                |> sort(columns: ["_time"])
+                |> keep(columns: ["_time", "value_gps_properties_latitude", "value_gps_properties_longitude"])
+                |> rename(columns: {{
+                    _time: "time",
+                    value_gps_properties_latitude: "latitude",
+                    value_gps_properties_longitude: "longitude"
+                }})
+            union(tables: [positions |> first(column: "time"), positions |> last(column: "time")])
+                |> group()
+                |> unique(column: "time")
+                |> sort(columns: ["time"])
+        '''
+
+    def _build_latest_position_time_query(self) -> str:
+        """Build latest position time query for busId since rangeStart"""
+        return '''
+            from(bucket: bucketName)
+                |> range(start: rangeStart)
+                |> filter(fn: (r) => r["_measurement"] == "mqtt_consumer")
+                |> filter(fn: (r) => r["_field"] == "value_gps_properties_latitude")
+                |> filter(fn: (r) => r["thingId"] == busId)
+                |> last()
+                |> keep(columns: ["_time"])
         '''
 
-    def _build_last_value_query(self, bus_id: str, field: str) -> str:
-        """Build last value query"""
+    def _build_last_values_query(self, field_names: List[str]) -> str:
+        """
+        Build query for the last value of each of the given fields of busId since rangeStart, as strings.
+        Fields are compared with == rather than contains(), so the filters are pushed down to storage.
+
+        :param field_names: Field names, fixed by the caller and never user input
+        """
+        field_filter = " or ".join(f'r["_field"] == "{name}"' for name in field_names)
         return f'''
-            from(bucket: "{self.bucket}")
-                |> range(start: -1d)
+            from(bucket: bucketName)
+                |> range(start: rangeStart)
                 |> filter(fn: (r) => r["_measurement"] == "mqtt_consumer")
-                |> filter(fn: (r) => r["_field"] == "{field}")
-                |> filter(fn: (r) => r["thingId"] == "{bus_id}")
+                |> filter(fn: (r) => r["thingId"] == busId)
+                |> filter(fn: (r) => {field_filter})
                 |> last()
                 |> map(fn: (r) => ({{
+                    _field: r._field,
                     valor: string(v: r._value)
                 }}))
         '''
 
-    def _process_positions(self, tables) -> List[Dict[str, Any]]:
-        """Process position results into dictionaries"""
-        data = []
-        for table in tables:
-            for row in table.records:
-                try:
-                    data.append({
-                        'time': row.values['_time'],
-                        'latitude': row.values.get('value_gps_properties_latitude'),
-                        'longitude': row.values.get('value_gps_properties_longitude')
-                    })
-                except KeyError as e:
-                    logging.warning(f"Missing position data: {e}")
-        return data
+    def _build_stops_query(self) -> str:
+        """Build query for the ordered stops of a line and direction, with parameters lineId, direction, rangeStart"""
+        return '''
+        import "strings"
+    
+        linea =
+          from(bucket: bucketName)
+              |> range(start: rangeStart)
+              |> filter(fn: (r) => r["_measurement"] == "mqtt_consumer")
+              |> filter(fn: (r) => r["_field"] =~ /^value_stops_properties_\\d+_(orden|sentido)$/)
+              |> filter(fn: (r) => r["thingId"] == "lines:" + lineId)
+              |> last()
+              |> map(fn: (r) => ({
+            codLinea: r["thingId"],
+                  codParada: strings.split(v: r._field, t: "_")[3],
+                  tipo: strings.split(v: r._field, t: "_")[4],
+                  valor: r._value,
+                  _time: r._time
+                }))
+              |> pivot(rowKey: ["_time", "codLinea", "codParada"], columnKey: ["tipo"], valueColumn: "valor")
+              |> filter(fn: (r) => exists r.sentido and string(v: r.sentido) == direction)
+              |> map(fn: (r) => ({
+            codParada: r.codParada,
+                  orden: int(v: r.orden)
+                }))
+              |> sort(columns: ["orden"], desc: false)
+    
+        paradas =
+          from(bucket: bucketName)
+            |> range(start: rangeStart)
+            |> filter(fn: (r) => r["_measurement"] == "mqtt_consumer")
+            |> filter(fn: (r) => r["_field"] == "value_stop_properties_latitud" or 
+                                 r["_field"] == "value_stop_properties_longitud")
+            |> last()
+            |> map(fn: (r) => ({
+            codParada: strings.trimPrefix(v: r["thingId"], prefix: "stops:"),
+                tipo: if r["_field"] == "value_stop_properties_latitud" then "latitud" else "longitud",
+                valor: r._value,
+                _time: r._time
+              }))
+            |> pivot(rowKey: ["_time", "codParada"], columnKey: ["tipo"], valueColumn: "valor")
+    
+        join(
+          tables: {linea: linea, paradas: paradas},
+          on: ["codParada"]
+        )
+          |> map(fn: (r) => ({
+            codParada: r.codParada,
+              orden: r.orden,
+              latitud: float(v: r.latitud),
+              longitud: float(v: r.longitud)
+            }))
+          |> sort(columns: ["orden"], desc: false)
+          |> yield(name: "ParadasConCoordenadas")
+            '''
+
+    def _current_route_positions(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Keep the positions since the bus last changed its line code or direction, oldest first
+
+        :param df: Positions of a single bus with code and direction columns
+        :return: Positions of the current route
+        """
+        df = df.dropna(subset=['time']).sort_values('time', ascending=False)
+        if df.empty:
+            return df
+
+        # Missing values take the closest newer one, so they never count as a change on their own
+        route = df.reindex(columns=ROUTE_COLUMNS).ffill().bfill().fillna(-1)
+        changed = route.ne(route.iloc[0]).any(axis=1).cummax()
+        return df[~changed.to_numpy()].iloc[::-1]
+
+    def _position_records(self, df: pd.DataFrame) -> List[Dict[str, Any]]:
+        """Convert a positions DataFrame into dictionaries"""
+        return df.reindex(columns=POSITION_COLUMNS).dropna(subset=['time']).to_dict(orient='records')
+
+    def _process_positions(self, df: pd.DataFrame) -> List[Dict[str, Any]]:
+        """Process the positions of a bus into dictionaries of its current route ordered by time"""
+        if df.empty or 'time' not in df:
+            return []
+
+        return self._position_records(self._current_route_positions(df))
 
     def _valid_bus_id(self, bus_id: str) -> bool:
         """Validate bus ID format"""
-        if not (isinstance(bus_id, str) and ":" in bus_id):
-            logging.error(f"Invalid bus_id format: {bus_id}")
+        if not (isinstance(bus_id, str) and _BUS_ID_RE.match(bus_id)):
+            logger.error("Invalid bus_id format: %r", bus_id)
             return False
         return True
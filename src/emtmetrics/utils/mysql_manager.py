@@ -1,15 +1,41 @@
 import logging
+import os
+import threading
 
 import mysql.connector
+import numpy as np
 from mysql.connector import Error
-from typing import List, Tuple, Optional
+from mysql.connector.errors import PoolError
+from mysql.connector.pooling import CNX_POOL_MAXSIZE, MySQLConnectionPool
+from typing import Any, Optional
+
+from ..model.shape_arrays import ShapeArrays
 
 
 logger = logging.getLogger(__name__)
 
 
+def influx_line_id(route_id: Any) -> str:
+    """
+    Format a GTFS route_id as InfluxDB reports line codes, e.g. 3 -> "3.0", so it matches
+    InfluxDBManager.get_bus_route and the "lines:" thing IDs. Non numeric codes are kept as they are.
+    """
+    try:
+        return str(float(route_id))
+    except (TypeError, ValueError):
+        return str(route_id).strip()
+
+
+def influx_direction(direction_id: Any) -> str:
+    """Format a GTFS direction_id as InfluxDB reports directions, e.g. "02" or 2.0 -> "2" """
+    try:
+        return str(int(float(direction_id)))
+    except (TypeError, ValueError):
+        return str(direction_id).strip()
+
+
 class MySQLManager:
-    def __init__(self, host: str, user: str, password: str, database: str):
+    def __init__(self, host: str, user: str, password: str, database: str, pool_size: Optional[int] = None):
         """
         Initialize the database connection manager.
 
@@ -17,124 +43,158 @@ class MySQLManager:
         :param user: Database username
         :param password: Database password
         :param database: Database name
+        :param pool_size: Size of the connection pool (default: MYSQL_POOL_SIZE env var or 16, max 32)
+        :raises ValueError: If the pool size is not a positive integer
         """
         self.host = host
         self.user = user
         self.password = password
         self.database = database
+        self.pool_size = self._resolve_pool_size(pool_size)
+        self._pool: Optional[MySQLConnectionPool] = None
+        self._pool_lock = threading.Lock()
+
+    @staticmethod
+    def _resolve_pool_size(pool_size: Optional[int]) -> int:
+        """Validate the pool size, failing at startup rather than on the first query"""
+        if pool_size is None:
+            value = os.environ.get("MYSQL_POOL_SIZE", "16")
+            try:
+                pool_size = int(value)
+            except ValueError:
+                raise ValueError(f"MYSQL_POOL_SIZE must be an integer, got {value!r}") from None
+
+        if pool_size < 1:
+            raise ValueError(f"MySQL pool size must be at least 1, got {pool_size}")
+        if pool_size > CNX_POOL_MAXSIZE:
+            logger.warning("MySQL pool size %d is above the connector's maximum, using %d",
+                           pool_size, CNX_POOL_MAXSIZE)
+            return CNX_POOL_MAXSIZE
+        return pool_size
+
+    def _get_pool(self) -> MySQLConnectionPool:
+        """Create the connection pool on first use"""
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    self._pool = MySQLConnectionPool(
+                        pool_name="emt",
+                        pool_size=self.pool_size,
+                        host=self.host,
+                        user=self.user,
+                        password=self.password,
+                        database=self.database
+                    )
+        return self._pool
 
     def _get_connection(self):
-        """Create and return a new database connection"""
-        return mysql.connector.connect(
-            host=self.host,
-            user=self.user,
-            password=self.password,
-            database=self.database
-        )
+        """Get a pooled database connection, or a new one if the pool is exhausted"""
+        try:
+            return self._get_pool().get_connection()
+        except PoolError:
+            logger.warning("MySQL connection pool exhausted, opening a new connection")
+            return mysql.connector.connect(
+                host=self.host,
+                user=self.user,
+                password=self.password,
+                database=self.database
+            )
 
-    def shape_points(self, shape_id: int) -> List[Tuple[float, float, int, float]]:
+    def shape_points(self, shape_id: int) -> ShapeArrays:
         """
         Get shape points for a given shape ID
 
         :param shape_id: Shape identifier
-        :return: List of tuples (lat, lon, sequence, distance)
+        :return: Shape point columns (lat, lon, sequence, distance) ordered by sequence
         """
         try:
             with self._get_connection() as conexion:
-                if conexion.is_connected():
-                    with conexion.cursor() as cursor:
-                        query = """
-                            SELECT shape_pt_lat, shape_pt_lon, 
-                                   shape_pt_sequence, shape_dist_traveled 
-                            FROM shapes 
-                            WHERE shape_id = %s
-                            ORDER BY shape_pt_sequence
-                        """
-                        cursor.execute(query, (shape_id,))
-                        return cursor.fetchall()
+                with conexion.cursor() as cursor:
+                    query = """
+                        SELECT CAST(shape_pt_lat AS DOUBLE), CAST(shape_pt_lon AS DOUBLE), 
+                               shape_pt_sequence, CAST(shape_dist_traveled AS DOUBLE) 
+                        FROM shapes 
+                        WHERE shape_id = %s
+                        ORDER BY shape_pt_sequence
+                    """
+                    cursor.execute(query, (shape_id,))
+                    rows = np.asarray(cursor.fetchall(), dtype=np.float64).reshape(-1, 4)
         except Error as e:
             # Handle logging appropriately in your environment
             print(f"Database error: {e}")
-            return []
+            rows = np.empty((0, 4), dtype=np.float64)
+
+        return ShapeArrays(
+            lat=np.ascontiguousarray(rows[:, 0]),
+            lon=np.ascontiguousarray(rows[:, 1]),
+            seq=rows[:, 2].astype(np.int32),
+            dist=np.ascontiguousarray(rows[:, 3])
+        )
 
-    def dist_traveled(self, shape_id: int,
-                      shape_pt_lat: float,
-                      shape_pt_lon: float) -> Optional[float]:
+    def get_coordinates(self, shape_id: int, dist_traveled: int) -> Optional[tuple[float, float]]:
         """
-        Get distance traveled for a specific shape point
+        Get (lat, lon) for a specific shape point's dist traveled
 
         :param shape_id: Shape identifier
-        :param shape_pt_lat: Point latitude
-        :param shape_pt_lon: Point longitude
-        :return: Distance traveled or None if not found
+        :param dist_traveled: Point's distance traveled
+        :return: (lat, lon) or None if not found
         """
         try:
             with self._get_connection() as conexion:
-                if conexion.is_connected():
-                    with conexion.cursor() as cursor:
-                        query = """
-                            SELECT shape_dist_traveled 
-                            FROM shapes 
-                            WHERE shape_id = %s 
-                            AND ABS(shape_pt_lat - %s) < 0.000001
-                            AND ABS(shape_pt_lon - %s) < 0.000001
-                            LIMIT 1
-                        """
-                        cursor.execute(query, (shape_id, shape_pt_lat, shape_pt_lon))
-                        result = cursor.fetchone()
-                        return result[0] if result else None
+                with conexion.cursor() as cursor:
+                    query = """
+                        SELECT CAST(shape_pt_lat AS DOUBLE), CAST(shape_pt_lon AS DOUBLE) 
+                        FROM shapes 
+                        WHERE shape_id = %s 
+                        AND shape_dist_traveled = %s
+                        LIMIT 1
+                    """
+                    cursor.execute(query, (shape_id, dist_traveled))
+                    result = cursor.fetchone()
+                    return (result[0], result[1]) if result else None
         except Error as e:
             print(f"Database error: {e}")
             return None
 
-    def get_coordinates(self, shape_id: int, dist_traveled: int) -> Optional[tuple[float, float]]:
+    def line_directions(self) -> list[tuple[str, str]]:
         """
-        Get (lat, lon) for a specific shape point's dist traveled
+        Get every line and direction with trips
 
-        :param shape_id: Shape identifier
-        :param dist_traveled: Point's distance traveled
-        :return: (lat, lon) or None if not found
+        :return: List of (line, sentido) pairs formatted as InfluxDBManager.get_bus_route returns them,
+                 so they are the same keys used to look up stops at request time
         """
         try:
             with self._get_connection() as conexion:
-                if conexion.is_connected():
-                    with conexion.cursor() as cursor:
-                        query = """
-                            SELECT shape_pt_lat, shape_pt_lon 
-                            FROM shapes 
-                            WHERE shape_id = %s 
-                            AND shape_dist_traveled = %s
-                            LIMIT 1
-                        """
-                        cursor.execute(query, (shape_id, dist_traveled))
-                        result = cursor.fetchone()
-                        return (result[0], result[1]) if result else None
+                with conexion.cursor() as cursor:
+                    cursor.execute("SELECT DISTINCT route_id, direction_id FROM trips_summary")
+                    pairs = {(influx_line_id(line_id), influx_direction(direction_id))
+                             for line_id, direction_id in cursor.fetchall()}
+                    return sorted(pairs)
         except Error as e:
-            print(f"Database error: {e}")
-            return None
+            logger.error("Database error: %s", e)
+            return []
 
     def get_bus_shape(self, line_id: str, direction_id: str) -> Optional[int]:
         try:
             with self._get_connection() as conexion:
-                if conexion.is_connected():
-                    with conexion.cursor() as cursor:
-                        query = """
-                            SELECT shape_id 
-                            FROM trips_summary 
-                            WHERE route_id = %s 
-                            AND direction_id = %s
-                            LIMIT 1
-                        """
-                        cursor.execute(query, (line_id, int(direction_id)))
-                        result = cursor.fetchone()
-                        if result and result[0] is not None:
-                            try:
-                                return int(result[0])
-                            except ValueError:
-                                logger.error(f"shape_id '{result[0]}' is not convertible to int.")
-                                return None
-                        else:
+                with conexion.cursor() as cursor:
+                    query = """
+                        SELECT shape_id 
+                        FROM trips_summary 
+                        WHERE route_id = %s 
+                        AND direction_id = %s
+                        LIMIT 1
+                    """
+                    cursor.execute(query, (line_id, int(direction_id)))
+                    result = cursor.fetchone()
+                    if result and result[0] is not None:
+                        try:
+                            return int(result[0])
+                        except ValueError:
+                            logger.error(f"shape_id '{result[0]}' is not convertible to int.")
                             return None
+                    else:
+                        return None
         except Error as e:
             print(f"Database error: {e}")
             return None
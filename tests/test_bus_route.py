@@ -0,0 +1,44 @@
+import unittest
+from types import SimpleNamespace
+
+from emtmetrics.utils.influxdb_manager import InfluxDBManager, LAST_VALUES_WINDOWS
+
+
+class FakeQueryApi:
+    """Answers route queries as Flux does, string(v: r._value), and records the range of each one"""
+
+    def __init__(self, routes):
+        self.routes = routes
+        self.ranges = []
+
+    def query(self, query, org, params=None):
+        self.ranges.append(params['rangeStart'])
+        fields = zip(("value_line_properties_code", "value_line_properties_direction"),
+                     self.routes.get(params['busId'], ()))
+        records = [SimpleNamespace(values={'_field': field, 'valor': value}) for field, value in fields]
+        return [SimpleNamespace(records=records)]
+
+
+class BusRouteTest(unittest.TestCase):
+    def setUp(self):
+        self.query_api = FakeQueryApi({"buses:1": ("3.0", "2")})
+        self.manager = InfluxDBManager("url", "org", "token")
+        self.manager._query_api = self.query_api
+
+    def test_known_bus_is_found_in_the_narrowest_range(self):
+        self.assertEqual(self.manager.get_bus_route("buses:1"), {'linea': "3.0", 'sentido': "2"})
+        self.assertEqual(self.manager.get_bus_route("buses:1"), {'linea': "3.0", 'sentido': "2"})
+        self.assertEqual(self.query_api.ranges, [-LAST_VALUES_WINDOWS[0]])
+
+    def test_unknown_bus_widens_once_then_is_remembered(self):
+        for _ in range(3):
+            self.assertEqual(self.manager.get_bus_route("buses:999"), {'linea': None, 'sentido': None})
+        self.assertEqual(self.query_api.ranges, [-window for window in LAST_VALUES_WINDOWS])
+
+    def test_invalid_bus_id_is_not_queried(self):
+        self.assertEqual(self.manager.get_bus_route('buses:1" or true'), {'linea': None, 'sentido': None})
+        self.assertEqual(self.query_api.ranges, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
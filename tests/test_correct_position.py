@@ -0,0 +1,36 @@
+import unittest
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from emtmetrics.model.prediction_service_aux_data import RouteData
+from emtmetrics.utils.calculations import correct_position, precompute_segments, segment_lengths
+
+
+def make_route_data(with_tree: bool) -> RouteData:
+    route = np.column_stack((36.72 + np.arange(10) * 1e-4, np.full(10, -4.42)))
+    search_coordinates = route.astype(np.float32)
+    return RouteData(
+        1, route, np.arange(10) * 11.1, search_coordinates, *precompute_segments(route), segment_lengths(route),
+        cKDTree(search_coordinates) if with_tree else None
+    )
+
+
+class CorrectPositionTest(unittest.TestCase):
+    def test_projects_position_onto_route(self):
+        for with_tree in (False, True):
+            point, distance, _, segment_index = correct_position(make_route_data(with_tree), (36.72035, -4.42))
+            self.assertEqual(segment_index, 3)
+            self.assertAlmostEqual(point[0], 36.72035)
+            self.assertAlmostEqual(distance, 0.0)
+
+    def test_rejects_non_finite_position(self):
+        for with_tree in (False, True):
+            route_data = make_route_data(with_tree)
+            for position in ((np.nan, -4.42), (36.72, np.nan), {'latitude': np.inf, 'longitude': -4.42}):
+                with self.assertRaises(ValueError):
+                    correct_position(route_data, position)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+import unittest
+from decimal import Decimal
+from types import SimpleNamespace
+
+import pandas as pd
+
+from emtmetrics.utils.influxdb_manager import InfluxDBManager
+from emtmetrics.utils.mysql_manager import MySQLManager
+
+
+class FakeCursor:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, params=None):
+        pass
+
+    def fetchall(self):
+        return self.rows
+
+
+class FakeConnection:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def cursor(self):
+        return FakeCursor(self.rows)
+
+
+class FakeQueryApi:
+    """Answers route queries as Flux does, string(v: r._value), and counts stops queries"""
+
+    def __init__(self, routes):
+        self.routes = routes
+        self.stops_queries = 0
+
+    def query(self, query, org, params=None):
+        line, direction = self.routes[params['busId']]
+        records = [SimpleNamespace(values={'_field': 'value_line_properties_code', 'valor': line}),
+                   SimpleNamespace(values={'_field': 'value_line_properties_direction', 'valor': direction})]
+        return [SimpleNamespace(records=records)]
+
+    def query_data_frame(self, query, org, params=None):
+        self.stops_queries += 1
+        return pd.DataFrame([{'codParada': '1', 'orden': 1, 'latitud': 36.7, 'longitud': -4.4}])
+
+
+class LineDirectionsTest(unittest.TestCase):
+    def test_warmup_keys_match_request_keys(self):
+        # route_id and direction_id as MySQL may return them
+        mysql_manager = MySQLManager("host", "user", "password", "database")
+        rows = [(3, 2), ("3", "2"), (Decimal("27"), Decimal("1")), ("27", 1)]
+        mysql_manager._get_connection = lambda: FakeConnection(rows)
+
+        # Line and direction of the same lines as InfluxDB reports them
+        query_api = FakeQueryApi({"buses:1": ("3.0", "2"), "buses:2": ("27.0", "1")})
+        influxdb_manager = InfluxDBManager("url", "org", "token")
+        influxdb_manager._query_api = query_api
+
+        pairs = mysql_manager.line_directions()
+        routes = [influxdb_manager.get_bus_route(bus_id) for bus_id in ("buses:1", "buses:2")]
+        self.assertEqual(pairs, sorted((route['linea'], route['sentido']) for route in routes))
+
+        self.assertEqual(influxdb_manager.warmup(pairs), 2)
+        self.assertEqual(query_api.stops_queries, 2)
+        for route in routes:
+            influxdb_manager.get_stops_for_line_and_direction(route['linea'], route['sentido'])
+        self.assertEqual(query_api.stops_queries, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
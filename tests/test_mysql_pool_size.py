@@ -0,0 +1,35 @@
+import os
+import unittest
+from unittest import mock
+
+from emtmetrics.utils.mysql_manager import MySQLManager
+
+
+def make_manager(pool_size=None):
+    return MySQLManager("host", "user", "password", "database", pool_size=pool_size)
+
+
+class PoolSizeTest(unittest.TestCase):
+    def test_default_and_env(self):
+        with mock.patch.dict(os.environ, {}, clear=True):
+            self.assertEqual(make_manager().pool_size, 16)
+        with mock.patch.dict(os.environ, {"MYSQL_POOL_SIZE": "8"}):
+            self.assertEqual(make_manager().pool_size, 8)
+
+    def test_clamped_to_connector_maximum(self):
+        with mock.patch.dict(os.environ, {"MYSQL_POOL_SIZE": "64"}):
+            with self.assertLogs("emtmetrics.utils.mysql_manager", "WARNING"):
+                self.assertEqual(make_manager().pool_size, 32)
+        with self.assertLogs("emtmetrics.utils.mysql_manager", "WARNING"):
+            self.assertEqual(make_manager(100).pool_size, 32)
+
+    def test_invalid_values_fail_fast(self):
+        with mock.patch.dict(os.environ, {"MYSQL_POOL_SIZE": "sixteen"}):
+            with self.assertRaisesRegex(ValueError, "MYSQL_POOL_SIZE"):
+                make_manager()
+        with self.assertRaises(ValueError):
+            make_manager(0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,30 @@
+import unittest
+
+import numpy as np
+
+from emtmetrics.model.shape_arrays import ShapeArrays
+from emtmetrics.service.prediction_service import PredictionService
+from emtmetrics.utils.calculations import correct_position
+
+
+class FakeMySQLManager:
+    def shape_points(self, shape_id):
+        lat = 36.72 + np.arange(10) * 1e-4
+        return ShapeArrays(lat=lat, lon=np.full(10, -4.42), seq=np.arange(10, dtype=np.int32),
+                           dist=np.arange(10) * 11.1)
+
+
+class RouteDataTest(unittest.TestCase):
+    def test_position_on_route_is_projected_without_float32_rounding(self):
+        route_data = PredictionService(None, FakeMySQLManager())._load_route_data(1)
+        self.assertEqual(route_data.search_coordinates.dtype, np.float32)
+
+        point, distance, _, segment_index = correct_position(route_data, (36.72045, -4.42))
+        self.assertEqual(segment_index, 4)
+        self.assertAlmostEqual(point[0], 36.72045, places=12)
+        self.assertAlmostEqual(point[1], -4.42, places=12)
+        self.assertAlmostEqual(distance, 0.0, places=12)
+
+
+if __name__ == "__main__":
+    unittest.main()